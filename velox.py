@@ -2,108 +2,283 @@
 
 import argparse
 import asyncio
+import hashlib
 import json
+import logging
+import logging.handlers
 import os
+import queue
 import re
+import stat
 import sys
+import tempfile
+import time
 
-import requests
+import httpx
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 from telegram import Update
 from telegram.constants import ParseMode
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+from telegram.ext import AIORateLimiter, ApplicationBuilder, CommandHandler, ContextTypes
+
+# use orjson for the state files when available, it is much faster than the stdlib json
+try:
+    import orjson
+
+    def json_dumps(obj, indent=False):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj, indent=False):
+        return json.dumps(obj, indent=2 if indent else None).encode('utf-8')
+
+    json_loads = json.loads
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
+logger = logging.getLogger("velox")
 
-def generate_maps_base_url(lat_long_t):
-    return f"https://www.google.com/maps/search/?api=1&query={lat_long_t[0]}%2C{lat_long_t[1]}"
+# the process umask can only be read by setting it, do it once while still single-threaded
+UMASK = os.umask(0)
+os.umask(UMASK)
 
+# shared async client, so that connections to the police website are kept alive
+# and fetching does not block the event loop
+CLIENT = httpx.AsyncClient(limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+                           timeout=30, http2=True, headers={'User-Agent': 'Mozilla/5.0'},
+                           follow_redirects=True)
 
-def fetch_current_dict():
-    """Fetch the current velox list and returns it as a {location_name:maps_url} dict"""
-    url = 'https://polizei.lu.ch/organisation/sicherheit_verkehrspolizei/verkehrspolizei/spezialversorgung/verkehrssicherheit/Aktuelle_Tempomessungen'
+# extracts the coordinates from the onclick handler of each radar list entry
+FLYTO_RE = re.compile(r"map\.flyTo\(\[([^,]+),([^\]]+)\]")
 
-    response = requests.get(url, timeout=30, headers={'User-Agent': 'Mozilla/5.0'})
-    if response.status_code != 200:
-        print(f"Failed to make request. Status code: {response.status_code}")
-        return None
+# last fetched velox list, reused for CACHE_TTL seconds to avoid redundant scrapes,
+# along with its maps urls and the coords path of the /show_map url
+CACHE_TTL = 300
+_CACHE = {'ts': 0, 'val': None, 'urls': None, 'coords_path': None}
+
+# validators, body hash and parsed list of the last fetch, loaded from http_cache.json on first access
+_HTTP_CACHE = None
+
+# registered chats, loaded from chat_ids.json on first access
+_CHATS = None
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-    radar_list_div = soup.find('div', {'id': 'radarList'})
-    if not radar_list_div:
-        print("Could not find div with id 'radarList'")
+# last saved velox list and its location names, loaded from previous_dict.json on first access
+_PREVIOUS_DICT = None
+_PREVIOUS_KEYS = None
+
+
+def atomic_write(path, data):
+    """Write `data` to `path` through a temporary file, so that a crash never leaves it half-written"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # mkstemp creates the file as 0600, keep the permissions a plain open() would give
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~UMASK
+        os.chmod(tmp_path, mode)
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+async def atomic_write_async(path, data):
+    """Run atomic_write in the default executor, so that it does not block the event loop"""
+    await asyncio.get_running_loop().run_in_executor(None, atomic_write, path, data)
+
+
+def generate_maps_base_url(lat_long_t):
+    return f"https://www.google.com/maps/search/?api=1&query={lat_long_t[0]}%2C{lat_long_t[1]}"
+
+
+def parse_current_dict(html):
+    """Parse the radar list page (str or utf-8 bytes) and return it as a {location_name:(lat, long)} dict"""
+    tree = LexborHTMLParser(html)
+    radar_list_div = tree.css_first('div#radarList')
+    if radar_list_div is None:
+        logger.error("Could not find div with id 'radarList'")
         return None
 
-    li_tags = radar_list_div.find_all('li')
+    li_tags = radar_list_div.css('li')
 
     # exclude the last <li> tag since it is a (rather useless) link to the map itself
     li_tags = li_tags[:-1]
 
     current_dict = {}
     for li in li_tags:
-        a_tag = li.find('a')
+        a_tag = li.css_first('a')
 
         # extract and store the text content and coordinates
-        if a_tag:
-            match = re.search(r"map\.flyTo\(\[(.*?),(.*?)\]", a_tag.get('onclick', ''))
+        if a_tag is not None:
+            velox = a_tag.text()
+            match = FLYTO_RE.search(a_tag.attributes.get('onclick') or '')
             if match:
                 lat = match.group(1).strip()
                 long = match.group(2).strip()
                 # velox_url = f"https://www.google.com/maps/search/?api=1&query={lat}%2C{long}"
             else:
-                print(f"Error: couldn't retrieve coordinates for {a_tag.text}")
+                logger.error("Couldn't retrieve coordinates for %s", velox)
                 lat = long = None
 
-            current_dict[a_tag.text] = (lat, long)
+            current_dict[velox] = (lat, long)
 
     return current_dict
 
 
-def save_chats(chat_ids):
-    with open(f'{BASE_DIR}/chat_ids.json', 'w', encoding='utf-8') as f:
-        json.dump(chat_ids, f, indent=2)
+def get_http_cache():
+    """Return the validators, body hash and parsed list of the last fetch, reading http_cache.json only on first access"""
+    global _HTTP_CACHE
+    if _HTTP_CACHE is None:
+        try:
+            with open(f'{BASE_DIR}/http_cache.json', 'rb') as f:
+                _HTTP_CACHE = json_loads(f.read())
+        except (FileNotFoundError, ValueError):
+            _HTTP_CACHE = {}
+
+    return _HTTP_CACHE
+
+
+async def save_http_cache(http_cache):
+    global _HTTP_CACHE
+    _HTTP_CACHE = http_cache
+
+    await atomic_write_async(f'{BASE_DIR}/http_cache.json', json_dumps(http_cache))
+
+
+async def fetch_current_dict(force=False):
+    """Fetch the current velox list and returns it as a {location_name:maps_url} dict
+
+    A cached result younger than CACHE_TTL seconds is returned unless `force` is set.
+    Otherwise a conditional request is made, and the page is only parsed if it changed
+    (i.e. neither a 304 is returned nor the hash of the body matches the last fetched one).
+    """
+    if not force and _CACHE['val'] is not None and time.monotonic() - _CACHE['ts'] < CACHE_TTL:
+        return _CACHE['val']
+
+    url = 'https://polizei.lu.ch/organisation/sicherheit_verkehrspolizei/verkehrspolizei/spezialversorgung/verkehrssicherheit/Aktuelle_Tempomessungen'
+
+    http_cache = get_http_cache()
+    headers = {}
+    if http_cache.get('current_dict') is not None:
+        if http_cache.get('etag'):
+            headers['If-None-Match'] = http_cache['etag']
+        if http_cache.get('last_modified'):
+            headers['If-Modified-Since'] = http_cache['last_modified']
+
+    response = await CLIENT.get(url, headers=headers)
+    if response.status_code == 304:
+        # unchanged since the last fetch, reuse the list parsed back then
+        current_dict = http_cache['current_dict']
+    elif response.status_code != 200:
+        logger.error("Failed to make request. Status code: %s", response.status_code)
+        return None
+    else:
+        content_hash = hashlib.blake2b(response.content, digest_size=16).hexdigest()
+        if content_hash == http_cache.get('hash') and http_cache.get('current_dict') is not None:
+            # same page as the last fetch, skip parsing it again
+            current_dict = http_cache['current_dict']
+        else:
+            # lexbor always reads bytes as utf-8: hand them over directly only in that case,
+            # skipping the str decoding of response.text, and otherwise let httpx decode
+            # the page with its declared charset
+            is_utf8 = (response.encoding or 'utf-8').lower() in ('utf-8', 'utf8')
+            html = response.content if is_utf8 else response.text
+            # parse in a worker thread so that the event loop stays responsive
+            current_dict = await asyncio.to_thread(parse_current_dict, html)
+            if current_dict is None:
+                return None
+
+        new_http_cache = {'etag': response.headers.get('ETag'),
+                          'last_modified': response.headers.get('Last-Modified'),
+                          'hash': content_hash, 'current_dict': current_dict}
+        if new_http_cache != http_cache:
+            await save_http_cache(new_http_cache)
+
+    _CACHE['ts'] = time.monotonic()
+    if current_dict is not _CACHE['val']:
+        _CACHE['val'] = current_dict
+        _CACHE['urls'] = {velox: generate_maps_base_url(lat_long_t)
+                          for velox, lat_long_t in current_dict.items()}
+        _CACHE['coords_path'] = "".join(f"{lat_long_t[0]},{lat_long_t[1]}/"
+                                        for lat_long_t in current_dict.values())
+
+    return current_dict
+
+
+async def fetch_current_urls(force=False):
+    """Like fetch_current_dict, but return the precomputed ({location_name:maps_url}, coords_path) tuple"""
+    if await fetch_current_dict(force=force) is None:
+        return None, None
+
+    return _CACHE['urls'], _CACHE['coords_path']
+
+
+async def save_chats(chat_ids):
+    global _CHATS
+    _CHATS = chat_ids
+
+    await atomic_write_async(f'{BASE_DIR}/chat_ids.json', json_dumps(chat_ids, indent=True))
 
 
 # save a new chat_id
-def save_chat_id(chat_id):
+async def save_chat_id(chat_id):
     chat_id = str(chat_id)
+    chat_ids = get_chats()
 
-    try:
-        with open(f'{BASE_DIR}/chat_ids.json', 'r', encoding='utf-8') as f:
-            chat_ids = json.load(f)
-    except FileNotFoundError:
-        chat_ids = {}
-
-    if chat_id in chat_ids.keys():
+    if chat_id in chat_ids:
         return False
 
-    print(f"New chat id {chat_id}")
+    logger.info("New chat id %s", chat_id)
     chat_ids[chat_id] = {"notify_for_no_updates": False}
 
-    save_chats(chat_ids)
+    await save_chats(chat_ids)
     return True
 
 
 def get_chats():
-    try:
-        with open(f'{BASE_DIR}/chat_ids.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # no previous users
-        return None
+    """Return the registered chats, reading chat_ids.json only on first access"""
+    global _CHATS
+    if _CHATS is None:
+        try:
+            with open(f'{BASE_DIR}/chat_ids.json', 'rb') as f:
+                _CHATS = json_loads(f.read())
+        except FileNotFoundError:
+            # no previous users
+            _CHATS = {}
 
+    return _CHATS
 
-def should_notify_no_updates(chat_id):
-    chat_id = str(chat_id)
-    chat_ids = get_chats()
 
-    if not chat_ids:
-        return False
+def get_previous_dict():
+    """Return the last saved velox list and the set of its location names,
+    reading previous_dict.json only on first access"""
+    global _PREVIOUS_DICT, _PREVIOUS_KEYS
+    if _PREVIOUS_DICT is None:
+        try:
+            with open(f'{BASE_DIR}/previous_dict.json', 'rb') as f:
+                _PREVIOUS_DICT = json_loads(f.read())
+        except (FileNotFoundError, ValueError):
+            _PREVIOUS_DICT = {}
+        _PREVIOUS_KEYS = set(_PREVIOUS_DICT)
+
+    return _PREVIOUS_DICT, _PREVIOUS_KEYS
+
+
+async def save_previous_dict(previous_dict):
+    global _PREVIOUS_DICT, _PREVIOUS_KEYS
+    _PREVIOUS_DICT = previous_dict
+    _PREVIOUS_KEYS = set(previous_dict)
 
-    return chat_ids[chat_id].get("notify_for_no_updates", False)
+    await atomic_write_async(f'{BASE_DIR}/previous_dict.json', json_dumps(previous_dict))
 
 
 async def broadcast(app, msg, no_updates):
@@ -112,20 +287,25 @@ async def broadcast(app, msg, no_updates):
     if not chat_ids:
         return None
 
-    for chat_id in chat_ids.keys():
-        chat_id = str(chat_id)
-        if no_updates and not should_notify_no_updates(chat_id):
-            continue
-        await app.bot.send_message(chat_id=chat_id, text=msg,
-                                   parse_mode=ParseMode.HTML,
-                                   disable_web_page_preview=True)
+    targets = [chat_id for chat_id, meta in chat_ids.items()
+               if not (no_updates and not meta.get("notify_for_no_updates", False))]
+
+    # send concurrently, the application's rate limiter keeps us within Telegram's limits
+    results = await asyncio.gather(*(app.bot.send_message(chat_id=chat_id, text=msg,
+                                                          parse_mode=ParseMode.HTML,
+                                                          disable_web_page_preview=True)
+                                     for chat_id in targets),
+                                   return_exceptions=True)
+    for chat_id, result in zip(targets, results):
+        if isinstance(result, Exception):
+            logger.error("Couldn't send message to %s: %s", chat_id, result)
 
 
 # command to handle /start
 async def cmd_start(update: Update,
                     context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    newly_subscribed = save_chat_id(chat_id)
+    newly_subscribed = await save_chat_id(chat_id)
     msg = "You're subscribed to updates."
     if not newly_subscribed:
         msg = "Already subscribed."
@@ -137,9 +317,15 @@ async def cmd_start(update: Update,
 async def cmd_current_list(update: Update,
                            context: ContextTypes.DEFAULT_TYPE):
 
-    msg = "Current List\n\n"
-    for velox, lat_long_t in fetch_current_dict().items():
-        msg += f"- <a href='{generate_maps_base_url(lat_long_t)}'>{velox}</a>\n"
+    urls, _ = await fetch_current_urls()
+    if urls is None:
+        await context.bot.send_message(chat_id=update.message.chat_id,
+                                       text="Failed to fetch updates.")
+        return
+
+    parts = ["Current List\n\n"]
+    parts.extend(f"- <a href='{url}'>{velox}</a>\n" for velox, url in urls.items())
+    msg = "".join(parts)
 
     await context.bot.send_message(chat_id=update.message.chat_id,
                                    text=msg, parse_mode=ParseMode.HTML,
@@ -150,13 +336,17 @@ async def cmd_current_list(update: Update,
 async def cmd_show_map(update: Update,
                        context: ContextTypes.DEFAULT_TYPE):
 
-    url = "https://www.google.com/maps/dir/"
+    url_prefix = "https://www.google.com/maps/dir/"
     # hardcoded coords of Luzern for map centering
     url_suffix = "//@47.0473835,8.2532969,12.25z"
 
-    for _, lat_long_t in fetch_current_dict().items():
-        url += f"{lat_long_t[0]},{lat_long_t[1]}/"
-    url += url_suffix
+    _, coords_path = await fetch_current_urls()
+    if coords_path is None:
+        await context.bot.send_message(chat_id=update.message.chat_id,
+                                       text="Failed to fetch updates.")
+        return
+
+    url = f"{url_prefix}{coords_path}{url_suffix}"
 
     msg = f"Velox map\n{url}"
 
@@ -183,7 +373,7 @@ async def cmd_set_notify_no_updates(update: Update,
     new_val = not chat_ids[chat_id]["notify_for_no_updates"]
     chat_ids[chat_id]["notify_for_no_updates"] = new_val
 
-    save_chats(chat_ids)
+    await save_chats(chat_ids)
 
     msg = "Disabled - no status updates if no changes are detected"
     if new_val:
@@ -194,58 +384,76 @@ async def cmd_set_notify_no_updates(update: Update,
 
 
 async def check_for_updates(app=None, save_list=True, forced_update=False):
-    """Check for changes and send updates to registered users"""
+    """Check for changes and send updates to registered users, returning the current list"""
 
     # fetch the current list
-    current_dict = fetch_current_dict()
+    current_dict = await fetch_current_dict(force=True)
     no_updates = False
 
     if current_dict is None:
         msg = "Failed to fetch updates."
 
-        print(msg)
+        logger.error(msg)
         if app:
             await broadcast(app, msg, no_updates=no_updates)
 
-        return
+        return None
 
-    set_current = set(current_dict.keys())
+    set_current = set(current_dict)
 
     # load previous dict
-    try:
-        with open(f'{BASE_DIR}/previous_dict.json', 'r', encoding='utf-8') as f:
-            previous_dict = json.load(f)
-            set_previous = set(previous_dict.keys())
-    except (FileNotFoundError, ValueError):
-        set_previous = set()
+    previous_dict, set_previous = get_previous_dict()
 
     # compare and find changes
     added = set_current - set_previous
     removed = set_previous - set_current
 
     # generate the message to send
-    msg = "Checking for updates\n\n"
+    parts = ["Checking for updates\n\n"]
     if added:
-        msg += "Added:\n"
-        for el in added:
-            msg += f"- <a href='{generate_maps_base_url(current_dict[el])}'>{el}</a>\n"
+        parts.append("Added:\n")
+        # the maps urls of the current list were precomputed by fetch_current_dict
+        parts.extend(f"- <a href='{_CACHE['urls'][el]}'>{el}</a>\n" for el in added)
     if removed:
-        msg += "Removed:\n"
-        for el in removed:
-            msg += f"- <a href='{generate_maps_base_url(previous_dict[el])}'>{el}</a>\n"
+        parts.append("Removed:\n")
+        parts.extend(f"- <a href='{generate_maps_base_url(previous_dict[el])}'>{el}</a>\n"
+                     for el in removed)
     if not added and not removed:
-        msg += "No changes detected."
+        parts.append("No changes detected.")
         # mask no_updates flag if forced_update
         no_updates = not forced_update
+    msg = "".join(parts)
 
-    print(msg)
+    logger.info(msg)
     if app:
         await broadcast(app, msg, no_updates=no_updates)
 
     if not no_updates and save_list:
         # save the current list
-        with open(f'{BASE_DIR}/previous_dict.json', 'w', encoding='utf-8') as f:
-            json.dump(current_dict, f)
+        await save_previous_dict(current_dict)
+
+    return current_dict
+
+
+async def close_client(_app=None):
+    await CLIENT.aclose()
+
+
+def setup_logging():
+    """Hand log records over to a background thread, so that the event loop never waits on stdout"""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    listener.start()
+    return listener
 
 
 def bot_start():
@@ -266,7 +474,16 @@ def bot_start():
         print("Error: no BOT_TOKEN in config.json. Please add it.")
         sys.exit(1)
 
-    app = ApplicationBuilder().token(configs["BOT_TOKEN"]).build()
+    log_listener = setup_logging()
+
+    # stay within Telegram's limits: 30 msg/s overall and 20 msg/min per group,
+    # and on a 429 pause all requests for the requested time before retrying once
+    rate_limiter = AIORateLimiter(overall_max_rate=30, overall_time_period=1,
+                                  group_max_rate=20, group_time_period=60,
+                                  max_retries=1)
+
+    app = ApplicationBuilder().token(configs["BOT_TOKEN"]).rate_limiter(rate_limiter) \
+        .post_shutdown(close_client).build()
 
     app.add_handler(CommandHandler("start",
                                    cmd_start))
@@ -294,6 +511,18 @@ def bot_start():
     )
 
     app.run_polling()
+    log_listener.stop()
+
+
+async def cli(cli_args):
+    try:
+        current_dict = await check_for_updates(save_list=cli_args.save_list)
+        if cli_args.print_list and current_dict:
+            print("\nCurrent list:")
+            for velox, lat_long_t in current_dict.items():
+                print(f"{velox}: {generate_maps_base_url(lat_long_t)}")
+    finally:
+        await close_client()
 
 
 # entry point
@@ -312,8 +541,6 @@ if args.telegram_bot:
     sys.exit(0)
 
 # cli section
-asyncio.run(check_for_updates(save_list=args.save_list))
-if args.print_list:
-    print("\nCurrent list:")
-    for velox, lat_long_t in fetch_current_dict().items():
-        print(f"{velox}: {generate_maps_base_url(lat_long_t)}")
+logging.basicConfig(stream=sys.stdout, format="%(message)s")
+logger.setLevel(logging.INFO)
+asyncio.run(cli(args))